@@ -1,58 +1,190 @@
 import sys
 import os
 import io
-import re
+import csv
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import chess
 import chess.pgn
 import chess.engine
-import pandas as pd
 import numpy as np
 
 ENGINE_DEPTH = 12
+ENGINE_HASH_MB = 1024  # Split between workers when analysing in parallel
 
 INACCURACY_DROP = -0.08
 MISTAKE_DROP = -0.15
 BLUNDER_DROP = -0.22
 
+# Plies are first searched at SHALLOW_DEPTH; only those whose shallow
+# drop reaches CANDIDATE_DROP are searched again at full depth
+SHALLOW_DEPTH = 6
+CANDIDATE_DROP = INACCURACY_DROP / 2
+
 NUM_GAMES_TO_ANALYSE = 100
 COLUMNS = ["position", "time_to_complete"]
 
+TT_MAX_ENTRIES = 200_000
+ENGINE_CACHE_FILE = "engine_cache.pkl"
+
+# Engine results keyed by (position, depth), shared across games and
+# persisted between runs in ENGINE_CACHE_FILE
+_tt = OrderedDict()
+_tt_new = {}  # Entries a worker has added since it last reported back
+
+# Move classification, indexed by np.digitize against the drop thresholds
+NAGS_BY_SEVERITY = [
+    [chess.pgn.NAG_BLUNDER],
+    [chess.pgn.NAG_MISTAKE],
+    [chess.pgn.NAG_DUBIOUS_MOVE],
+    [],
+]
 
-def win_probability(cp: float) -> float:
+
+def win_probability(cp: np.ndarray) -> np.ndarray:
     return 1 / (1 + np.exp(-cp / 116.0))
 
 
-def get_eval_and_score(info):
+def get_cp(info):
     score = info["score"].white()
     if score.is_mate():
-        cp = 10000 if score.mate() > 0 else -10000
-        eval_str = f"#{score.mate()}"
-    else:
-        cp = score.score()
-        eval_str = f"{cp/100:.2f}"
-    return cp, eval_str
-
+        return 10000 if score.mate() > 0 else -10000
+    return score.score()
 
-def classify_move(prev_cp, curr_cp, pov):
-    nags = []
 
-    if pov == "black":
-        prev_cp = -prev_cp
-        curr_cp = -curr_cp
+def _fmt_cp(cp: int) -> str:
+    sign = "-" if cp < 0 else ""
+    pawns, cents = divmod(abs(cp), 100)
+    return f"{sign}{pawns}.{cents:02d}"
 
-    prev_wp = win_probability(prev_cp)
-    curr_wp = win_probability(curr_cp)
-    drop = curr_wp - prev_wp
 
-    if drop <= BLUNDER_DROP:
-        nags = [chess.pgn.NAG_BLUNDER]
-    elif drop <= MISTAKE_DROP:
-        nags = [chess.pgn.NAG_MISTAKE]
-    elif drop <= INACCURACY_DROP:
-        nags = [chess.pgn.NAG_DUBIOUS_MOVE]
-
-    return nags
+def format_eval(info):
+    score = info["score"].white()
+    if score.is_mate():
+        return f"#{score.mate()}"
+    return _fmt_cp(score.score())
+
+
+def analyse_cached(engine, board, depth):
+    key = (board._transposition_key(), depth)
+    info = _tt.get(key)
+    if info is not None:
+        _tt.move_to_end(key)
+        return info
+    info = engine.analyse(board, chess.engine.Limit(depth=depth))
+    info = {"score": info["score"]}  # Only keep what we consume
+    _tt[key] = info
+    _tt_new[key] = info
+    if len(_tt) > TT_MAX_ENTRIES:
+        _tt.popitem(last=False)
+    return info
+
+
+def load_engine_cache(path=ENGINE_CACHE_FILE):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            _tt.update(pickle.load(f))
+
+
+def save_engine_cache(path=ENGINE_CACHE_FILE):
+    while len(_tt) > TT_MAX_ENTRIES:
+        _tt.popitem(last=False)
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump(_tt, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+
+def _init_worker(tt):
+    _tt.update(tt)
+
+
+def _comment_open(text, in_comment):
+    """Whether a {comment} is still open at the end of a movetext line"""
+    while True:
+        brace = text.find(b"}" if in_comment else b"{")
+        if brace < 0:
+            return in_comment
+        in_comment = not in_comment
+        text = text[brace + 1 :]
+
+
+def scan_pgn_offsets(path, max_games=None):
+    """Byte offsets of the start of each game, so workers can read
+    their own games straight from the file. Games are split where
+    python-chess splits them, at the first blank line after the movetext
+    outside a comment. Stops once the start of the game after max_games
+    is known"""
+    offsets = []
+    state = "between"  # Then "headers" and/or "movetext" within a game
+    in_comment = False
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            text = line.removeprefix(b"\xef\xbb\xbf").strip()
+            if state == "between":
+                if text and not text.startswith((b"%", b";")):
+                    offsets.append(offset)
+                    if max_games is not None and len(offsets) > max_games:
+                        break
+                    state = "headers" if text.startswith(b"[") else "movetext"
+            elif state == "headers":
+                if text and not text.startswith(b"["):
+                    state = "movetext"
+            elif not text and not in_comment:
+                state = "between"
+            if state == "movetext":
+                in_comment = _comment_open(text, in_comment)
+            offset += len(line)
+    return offsets
+
+
+def analyse_game(byte_range, pgn_path, **kwargs):
+    """Worker entry point: reads one game from pgn_path, runs analyse_pgn
+    and also returns the engine results it computed, so the parent can
+    persist them"""
+    start, end = byte_range
+    with open(pgn_path, "rb") as f:
+        f.seek(start)
+        # As text mode would: no BOM, and \n line endings within comments
+        pgn_text = f.read(end - start).decode("utf-8-sig").replace("\r\n", "\n")
+    annotated_pgn, positions_rows = analyse_pgn(pgn_text, **kwargs)
+    new_entries = dict(_tt_new)
+    _tt_new.clear()
+    return annotated_pgn, positions_rows, new_entries
+
+
+def analyse_backwards(engine, board, moves, depth, positions=None):
+    """Analyses the positions along moves from the last back to the first,
+    so the engine's hash already holds the lines reachable from each earlier
+    position. Returns {position index: info}, index 0 being the start"""
+    for move in moves:
+        board.push(move)
+    infos = {}
+    for ply in range(len(moves), -1, -1):
+        if positions is None or ply in positions:
+            infos[ply] = analyse_cached(engine, board, depth)
+        if ply:
+            board.pop()
+    return infos
+
+
+def probability_drops(infos, white_first):
+    """Change in win probability for the side making each move,
+    for a whole game at once"""
+    cps = np.array([get_cp(infos[pos]) for pos in range(len(infos))])
+    drops = np.diff(win_probability(cps))
+    drops[int(white_first) :: 2] *= -1  # Black's moves
+    return drops
+
+
+def classify_moves(drops):
+    severities = np.digitize(
+        drops, [BLUNDER_DROP, MISTAKE_DROP, INACCURACY_DROP], right=True
+    )
+    return [NAGS_BY_SEVERITY[severity] for severity in severities]
 
 
 def build_comment(curr_eval, nags):
@@ -68,29 +200,48 @@ def build_comment(curr_eval, nags):
     return comment.strip()
 
 
-def analyse_pgn(pgn_text, stockfish_path="stockfish", depth=20, df_positions=None):
+def analyse_pgn(
+    pgn_text,
+    stockfish_path="stockfish",
+    depth=20,
+    positions_rows=None,
+    threads=os.cpu_count(),
+    hash_mb=ENGINE_HASH_MB,
+):
+    if positions_rows is None:
+        positions_rows = []
+
     pgn = chess.pgn.read_game(io.StringIO(pgn_text))
+    if pgn is None:
+        return "", positions_rows
     white_player = pgn.headers.get("White", "")
     black_player = pgn.headers.get("Black", "")
     board = pgn.board()
 
-    if df_positions is None:
-        df_positions = pd.DataFrame(columns=COLUMNS)
-
     engine = chess.engine.SimpleEngine.popen_uci(stockfish_path)
-    info_before = engine.analyse(board, chess.engine.Limit(depth=depth))
+    engine.configure({"Threads": threads, "Hash": hash_mb})
+
+    nodes = list(pgn.mainline())
+    moves = [node.move for node in nodes]
+    white_first = board.turn == chess.WHITE
+
+    shallow_depth = min(SHALLOW_DEPTH, depth)
+    infos = analyse_backwards(engine, board, moves, shallow_depth)
+    drops = probability_drops(infos, white_first)
+    candidates = set(np.flatnonzero(drops <= CANDIDATE_DROP).tolist())
+    if depth > shallow_depth:
+        # The deep searches start with the shallow ones already in the hash
+        deep_positions = {pos for ply in candidates for pos in (ply, ply + 1)}
+        infos.update(analyse_backwards(engine, board, moves, depth, deep_positions))
+        drops = probability_drops(infos, white_first)
 
-    node = pgn
-    while node.variations:
-        prev_cp, _ = get_eval_and_score(info_before)
-        pov = "white" if board.turn == chess.WHITE else "black"
+    engine.quit()
 
-        next_node = node.variations[0]
-        move = next_node.move
-        board.push(move)
-        info_after = engine.analyse(board, chess.engine.Limit(depth=depth))
-        curr_cp, curr_eval = get_eval_and_score(info_after)
-        nags = classify_move(prev_cp, curr_cp, pov)
+    game_nags = classify_moves(drops)
+    for ply, next_node in enumerate(nodes):
+        board.push(next_node.move)
+        curr_eval = format_eval(infos[ply + 1])
+        nags = game_nags[ply] if ply in candidates else []
         for nag in nags:
             next_node.nags.add(nag)
         next_node.comment = build_comment(curr_eval, nags)
@@ -98,12 +249,7 @@ def analyse_pgn(pgn_text, stockfish_path="stockfish", depth=20, df_positions=Non
         if chess.pgn.NAG_BLUNDER in nags:
             mover = white_player if board.turn == chess.WHITE else black_player
             if mover in ("saintidle", "John"):
-                df_positions.loc[len(df_positions)] = [board.fen(), 300.0]
-
-        node = next_node
-        info_before = info_after
-
-    engine.quit()
+                positions_rows.append((board.fen(), 300.0))
 
     output = io.StringIO()
     exporter = chess.pgn.FileExporter(output)
@@ -112,7 +258,7 @@ def analyse_pgn(pgn_text, stockfish_path="stockfish", depth=20, df_positions=Non
         output.getvalue().replace(" $2", "?").replace(" $4", "??").replace(" $6", "?!")
     )
 
-    return annotated_pgn, df_positions
+    return annotated_pgn, positions_rows
 
 
 def main():
@@ -124,33 +270,55 @@ def main():
     base, _ = os.path.splitext(input_pgn_path)
     output_pgn_path = f"{base}_analysed.pgn"
 
-    df_positions = pd.DataFrame(columns=COLUMNS)
-
-    count = 1
-    annotated_games = []
-    with open(input_pgn_path, "r", encoding="utf-8") as fin:
-        while count <= NUM_GAMES_TO_ANALYSE:
-            print(f"Analysing game {count}...")
-            game = chess.pgn.read_game(fin)
-            if game is None:
-                break
-
-            raw_pgn = str(game)
-            annotated, df_positions = analyse_pgn(
-                raw_pgn,
-                stockfish_path="stockfish",
-                depth=ENGINE_DEPTH,
-                df_positions=df_positions,
-            )
-            annotated_games.append(annotated)
-            count += 1
-
-    with open(output_pgn_path, "w", encoding="utf-8") as fout:
-        fout.write("\n\n".join(annotated_games))
-    print(f"Written {output_pgn_path}")
-
-    df_positions.to_csv("positions_auto.csv", index=False)
-    print("Written positions_auto.csv")
+    offsets = scan_pgn_offsets(input_pgn_path, NUM_GAMES_TO_ANALYSE)
+    offsets.append(os.path.getsize(input_pgn_path))
+    game_ranges = list(zip(offsets, offsets[1:]))[:NUM_GAMES_TO_ANALYSE]
+
+    load_engine_cache()
+
+    # One single-threaded Stockfish per worker process, each analysing whole games
+    workers = os.cpu_count()
+    analyse = partial(
+        analyse_game,
+        pgn_path=input_pgn_path,
+        stockfish_path="stockfish",
+        depth=ENGINE_DEPTH,
+        threads=1,
+        hash_mb=ENGINE_HASH_MB // workers,
+    )
+    try:
+        # Results are written as each game completes, so an interrupted run
+        # keeps everything analysed so far
+        with (
+            open(output_pgn_path, "w", encoding="utf-8") as fout,
+            open("positions_auto.csv", "w", encoding="utf-8", newline="") as fcsv,
+            ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(_tt,)
+            ) as pool,
+        ):
+            positions_csv = csv.writer(fcsv, lineterminator="\n")
+            positions_csv.writerow(COLUMNS)
+            written = 0
+            for count, (annotated, game_rows, new_entries) in enumerate(
+                pool.map(analyse, game_ranges), start=1
+            ):
+                print(f"Analysed game {count}/{len(game_ranges)}")
+                if annotated:
+                    if written:
+                        fout.write("\n\n")
+                    fout.write(annotated)
+                    fout.flush()
+                    written += 1
+                positions_csv.writerows(game_rows)
+                fcsv.flush()
+                _tt.update(new_entries)
+
+        print(f"Written {output_pgn_path}")
+        print("Written positions_auto.csv")
+    finally:
+        # Keep what was computed even if a game fails or the run is interrupted
+        save_engine_cache()
+        print(f"Written {ENGINE_CACHE_FILE}")
 
 
 if __name__ == "__main__":
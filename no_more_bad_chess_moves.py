@@ -1,7 +1,15 @@
+import os
+import csv
 import time
+import atexit
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
 from PIL import Image, ImageTk
+import numpy as np
 import pandas as pd
 import chess
 import chess.engine
@@ -10,15 +18,46 @@ from maia2 import model, inference
 
 STOCKFISH_PATH = "/opt/homebrew/bin/stockfish"
 POSITIONS_FILE = "positions_auto.csv"
+# Results since POSITIONS_FILE was last rewritten, one "fen,time" line each
+POSITIONS_JOURNAL_FILE = "positions_auto.journal.csv"
+POSITIONS_SAVE_EVERY = 20
+PIECE_CACHE_DIR = "images/.cache"
 ENGINE_TIME_LIMIT = 0.25
-MAX_MOVES_TO_EVALUATE = 50
+ENGINE_MAX_DEPTH = 18
+ENGINE_STABLE_DEPTHS = 4  # Stop once the best move survives this many depths
+ENGINE_MIN_DEPTH = 12  # but never stop early below this depth
+# Cached results from searches cut short by the time limit below this
+# depth are redone on revisit, when the engine's hash lets the search get
+# deeper in the same time. Settled searches are always reused
+ENGINE_REUSE_DEPTH = 8
+ENGINE_INFO = chess.engine.INFO_SCORE | chess.engine.INFO_PV  # Fields we read
+ENGINE_LIMIT = chess.engine.Limit(time=ENGINE_TIME_LIMIT)
+ENGINE_ANALYSIS_LIMIT = chess.engine.Limit(
+    time=ENGINE_TIME_LIMIT, depth=ENGINE_MAX_DEPTH
+)
+ENGINE_THREADS = max(1, os.cpu_count() - 1)  # Leave a core for the GUI and Maia
+ENGINE_HASH_MB = 512
+MAX_MOVES_TO_EVALUATE = 5  # Other moves are searched only when played
+PREFETCH_LINES = 3  # Top engine lines whose follow-up positions are prefetched
+TT_MAX_ENTRIES = 100_000
+EVAL_CACHE_MAX_ENTRIES = 1_000
 INACCURACY_THRESHOLD = -0.8
 MISTAKE_THRESHOLD = -1.7
 BLUNDER_THRESHOLD = -2.8
 DARK_COLOR = "#669966"
 LIGHT_COLOR = "#99CC99"
 DEFAULT_TIME_TO_COMPLETE = 300
+POLL_INTERVAL_MS = 15
 MAIA2_ELO = 2000
+MAIA_PREFETCH_POSITIONS = 32
+MAIA_PREFETCH_CHUNK = 8  # A live evaluation waits for at most one chunk
+
+# Piece image names, indexed by (piece_type - 1) * 2 + color
+PIECE_IMAGE_NAMES = [
+    ("w" if color else "b") + chess.piece_symbol(piece_type).upper()
+    for piece_type in chess.PIECE_TYPES
+    for color in chess.COLORS[::-1]
+]
 
 
 class ChessModel:
@@ -26,12 +65,24 @@ class ChessModel:
         self.engine = None
         self.board = None
         self.positions = pd.DataFrame()
+        self._unsaved_results = 0
+        self._fen_rows = {}  # FEN -> labels of its rows in positions
         self.position = ""
         self.eval_data = pd.DataFrame()
+        self._eval_cache = OrderedDict()  # Whole evaluations by position
+        self.move_rows = {}  # SAN -> eval_data row label
+        self._san_cache = {}  # (position, move) -> SAN, for the current evaluation
         self.flip_board = False
-        self.piece_images = {}
-        self.maia2_model = model.from_pretrained(type="rapid", device="cpu")
-        self.maia2_prepared = inference.prepare()
+        self.piece_images = [None] * len(PIECE_IMAGE_NAMES)
+        self._tt = OrderedDict()  # Engine lines by position, least recent first
+        # Loads Maia off the main thread, then runs its inference while
+        # the engine searches the same position
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._maia = self._pool.submit(self._load_maia)
+        self._maia_lock = threading.RLock()  # Orders prefetch chunks with stop_maia
+        self._maia_stopped = False
+        self._maia_cache = {}  # FEN -> Maia move probabilities
+        self._san_probs = {}  # SAN -> Maia probability for the evaluated position
 
         self.rating_map = {
             5: "*****",
@@ -41,46 +92,112 @@ class ChessModel:
             1: "*",
         }
 
+    @staticmethod
+    def _load_maia():
+        return model.from_pretrained(type="rapid", device="cpu"), inference.prepare()
+
+    @property
+    def maia2_model(self):
+        return self._maia.result()[0]
+
+    @property
+    def maia2_prepared(self):
+        return self._maia.result()[1]
+
     def start_engine(self):
         self.engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+        # Multi-threaded search is not deterministic, so the order of
+        # near-equal moves may vary between runs
+        self.engine.configure({"Threads": ENGINE_THREADS, "Hash": ENGINE_HASH_MB})
 
     def stop_engine(self):
         if self.engine:
             self.engine.quit()
 
+    def stop_maia(self):
+        """Stops queueing prefetch chunks and drops any not yet started"""
+        with self._maia_lock:
+            self._maia_stopped = True
+        self._pool.shutdown(cancel_futures=True)
+
     def load_positions(self):
-        self.positions = pd.read_csv(POSITIONS_FILE)
+        # Explicit dtypes skip pandas' type inference on large files
+        self.positions = pd.read_csv(
+            POSITIONS_FILE,
+            usecols=["position", "time_to_complete"],
+            dtype={"position": str, "time_to_complete": float},
+        )
+        self.positions["position"] = self.positions["position"].str.strip()
+        self._fen_rows = {
+            fen: list(rows)
+            for fen, rows in self.positions.groupby("position").groups.items()
+        }
+        if os.path.exists(POSITIONS_JOURNAL_FILE):
+            # Left over from a run that exited without saving
+            with open(POSITIONS_JOURNAL_FILE, encoding="utf-8", newline="") as f:
+                for fen, ttc in csv.reader(f):
+                    self._set_time_to_complete(fen, float(ttc))
+            self.save_positions()
+        atexit.register(self.flush_positions)
 
     def save_positions(self):
         self.positions.sort_values(by="time_to_complete", ascending=True, inplace=True)
         self.positions.to_csv(POSITIONS_FILE, index=False)
+        if os.path.exists(POSITIONS_JOURNAL_FILE):
+            os.remove(POSITIONS_JOURNAL_FILE)
+        self._unsaved_results = 0
+
+    def flush_positions(self):
+        if self._unsaved_results:
+            self.save_positions()
 
     def load_piece_images(self, scale=1.0):
-        for color in ("b", "w"):
-            for pt in ("P", "R", "N", "B", "Q", "K"):
-                fname = f"images/{color}{pt}.png"
-                pil = Image.open(fname)
-                if scale != 1.0:
-                    w, h = pil.size
-                    pil = pil.resize(
-                        (int(w * scale), int(h * scale)), resample=Image.LANCZOS
-                    )
-                self.piece_images[color + pt] = ImageTk.PhotoImage(pil)
+        for i, pil in enumerate(self._scaled_piece_images(scale)):
+            self.piece_images[i] = ImageTk.PhotoImage(pil)
+
+    @staticmethod
+    def _scaled_piece_images(scale):
+        """Piece images at the given scale, in PIECE_IMAGE_NAMES order.
+        Resized once, then kept as raw pixels in a single cache file"""
+        cached = f"{PIECE_CACHE_DIR}/pieces_{int(scale * 1000)}.npz"
+        if os.path.exists(cached):
+            with np.load(cached) as atlas:
+                return [Image.fromarray(atlas[name]) for name in PIECE_IMAGE_NAMES]
+        images = []
+        for name in PIECE_IMAGE_NAMES:
+            with Image.open(f"images/{name}.png") as pil:
+                pil = pil.convert("RGBA")
+            if scale != 1.0:
+                w, h = pil.size
+                pil = pil.resize(
+                    (int(w * scale), int(h * scale)), resample=Image.LANCZOS
+                )
+            images.append(pil)
+        os.makedirs(PIECE_CACHE_DIR, exist_ok=True)
+        with open(f"{cached}.tmp", "wb") as f:
+            np.savez(f, **{n: np.asarray(p) for n, p in zip(PIECE_IMAGE_NAMES, images)})
+        os.replace(f"{cached}.tmp", cached)
+        return images
 
     def sample_new_position(self):
         """Samples a position from dataset
         weighted by how long the puzzle took to complete previously"""
         sample = self.positions.sample(n=1, weights="time_to_complete")
-        fen = sample.iloc[0]["position"].strip()
+        fen = sample.iloc[0]["position"]
         self.position = fen
         self.load_position_to_board(fen)
         return fen
 
     def load_position_to_board(self, fen):
+        if self.board is None:
+            self.board = chess.Board()
         try:
-            self.board = chess.Board(fen) if fen else chess.Board()
+            if fen:
+                self.board.set_fen(fen)
+            else:
+                self.board.reset()
         except ValueError:
-            self.board = chess.Board()
+            self.board.reset()
         self.flip_board = not self.board.turn
 
     def reload_position(self):
@@ -88,14 +205,28 @@ class ChessModel:
         return self.position
 
     def evaluate_position(self):
+        self._san_cache.clear()
+        key = (
+            self.board._transposition_key(),
+            MAX_MOVES_TO_EVALUATE,
+            ENGINE_TIME_LIMIT,
+        )
+        entry = self._eval_cache.get(key)
+        if entry is not None and self._reusable(entry):
+            self._eval_cache.move_to_end(key)
+            self.eval_data = entry["rows"]
+            self.move_rows = dict(entry["move_rows"])  # evaluate_move adds to it
+            self._san_probs = entry["san_probs"]
+            return
         self.eval_data = pd.DataFrame()  # Clear it out
-        self.evaluate_position_with_engine()
-        self.evaluate_position_with_maia()
+        maia = self._pool.submit(self.maia_move_probs, self.board.fen())
+        engine_entry = self.evaluate_position_with_engine()
+        self.evaluate_position_with_maia(maia.result())
         self.classify_all_moves()
         num_legal_moves = self.board.legal_moves.count()
-        assert num_legal_moves == len(
+        assert num_legal_moves >= len(
             self.eval_data
-        ), f"num_legal_moves {num_legal_moves} != len(self.eval_data){len(self.eval_data)}"
+        ), f"num_legal_moves {num_legal_moves} < len(self.eval_data){len(self.eval_data)}"
         self.eval_data = self.eval_data[  # Re-order columns
             [
                 "engine_rank",
@@ -108,21 +239,114 @@ class ChessModel:
                 "pv",
             ]
         ]
+        self.move_rows = dict(zip(self.eval_data["move"], self.eval_data.index))
+        self._eval_cache[key] = {
+            "rows": self.eval_data,
+            "move_rows": dict(self.move_rows),
+            "san_probs": self._san_probs,
+            "depth": engine_entry["depth"],
+            "settled": engine_entry["settled"],
+        }
+        if len(self._eval_cache) > EVAL_CACHE_MAX_ENTRIES:
+            self._eval_cache.popitem(last=False)
+
+    def analyse_cached(self, board, multipv, root_moves=None):
+        """Engine lines for board as (white score, pv) pairs, best first,
+        optionally searching only root_moves. Results are kept per position
+        so revisits skip the engine"""
+        key = (
+            board._transposition_key(),
+            multipv,
+            tuple(root_moves or ()),
+            ENGINE_TIME_LIMIT,
+        )
+        entry = self._tt.get(key)
+        if entry is not None and self._reusable(entry):
+            self._tt.move_to_end(key)
+            return entry
+        infos, settled = self.analyse_adaptive(board, multipv, root_moves)
+        entry = {
+            "depth": infos[0].get("depth", 0),
+            "settled": settled,
+            "lines": [(self._white_score(info), info.get("pv", [])) for info in infos],
+        }
+        self._tt[key] = entry
+        if len(self._tt) > TT_MAX_ENTRIES:
+            self._tt.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _reusable(entry):
+        return entry["settled"] or entry["depth"] >= ENGINE_REUSE_DEPTH
+
+    @staticmethod
+    def _white_score(info):
+        """Engine score in pawns from White's point of view"""
+        return info["score"].white().score(mate_score=10000) / 100
+
+    def analyse_adaptive(self, board, multipv, root_moves=None):
+        """Like engine.analyse with a time limit, but stops early once the
+        best move has stayed the same for ENGINE_STABLE_DEPTHS depths and
+        the search has reached ENGINE_MIN_DEPTH. Returns the lines and
+        whether the search settled, by stopping early or reaching
+        ENGINE_MAX_DEPTH, rather than running out of time"""
+        with self.engine.analysis(
+            board,
+            ENGINE_ANALYSIS_LIMIT,
+            multipv=multipv,
+            root_moves=root_moves,
+            info=ENGINE_INFO,
+        ) as analysis:
+            num_moves = len(root_moves) if root_moves else board.legal_moves.count()
+            num_lines = min(multipv, num_moves)
+            best_move, depth, stable, stop_depth = None, 0, 0, 0
+            for info in analysis:
+                if not info.get("pv"):
+                    continue
+                line = info.get("multipv", 1)
+                if line == 1 and not stop_depth and info.get("depth", 0) > depth:
+                    depth = info["depth"]
+                    if info["pv"][0] != best_move:
+                        best_move, stable = info["pv"][0], 0
+                    else:
+                        stable += 1
+                    if stable >= ENGINE_STABLE_DEPTHS and depth >= ENGINE_MIN_DEPTH:
+                        stop_depth = depth
+                # The other lines of a depth are reported after its best line,
+                # so wait for them to keep all lines from the same depth
+                if stop_depth and (
+                    line >= num_lines or info.get("depth", 0) > stop_depth
+                ):
+                    break
+            return analysis.multipv, bool(stop_depth) or depth >= ENGINE_MAX_DEPTH
+
+    def prefetch(self, board, cancel):
+        """Fills the engine cache with the positions reached after each of
+        the top engine moves and its expected reply, while the player thinks.
+        Stops between positions once cancel is set"""
+        lines = self.analyse_cached(board, MAX_MOVES_TO_EVALUATE)["lines"]
+        for _, pv in lines[:PREFETCH_LINES]:
+            if cancel.is_set():
+                return
+            if len(pv) < 2:
+                continue
+            board.push(pv[0])
+            board.push(pv[1])
+            try:
+                if not board.is_game_over():
+                    self.analyse_cached(board, MAX_MOVES_TO_EVALUATE)
+            finally:
+                board.pop()
+                board.pop()
 
     def evaluate_position_with_engine(self):
-        infos = self.engine.analyse(
-            self.board,
-            chess.engine.Limit(time=ENGINE_TIME_LIMIT),
-            multipv=MAX_MOVES_TO_EVALUATE,
-        )
-        best_eval = infos[0]["score"].white().score(mate_score=10000) / 100
+        entry = self.analyse_cached(self.board, MAX_MOVES_TO_EVALUATE)
+        lines = entry["lines"]
+        best_eval = lines[0][0]
         pa = []
-        for rank, info in enumerate(infos, start=1):
-            pv = info.get("pv", [])
-            move = self.board.san(pv[0])
-            pv = pv[:10]  # Truncate for readability
-            pv = self.board.variation_san(pv)
-            score = info["score"].white().score(mate_score=10000) / 100
+        for rank, (score, pv) in enumerate(lines, start=1):
+            move = self.cached_san(self.board, pv[0])
+            pv = pv[:10]  # Truncate for readability, formatted by with_pv_san
             diff = score - best_eval
             pa.append(
                 {
@@ -134,32 +358,149 @@ class ChessModel:
                 }
             )
         self.eval_data = pd.DataFrame(pa)
+        return entry
+
+    def cached_san(self, board, move):
+        """board.san(move), remembered until the next evaluation since
+        the same moves are rendered by the engine, Maia and move logging"""
+        key = (board._transposition_key(), move)
+        san = self._san_cache.get(key)
+        if san is None:
+            san = self._san_cache[key] = board.san(move)
+        return san
+
+    def with_pv_san(self, rows):
+        """Copy of some eval_data rows with their pv move lists rendered
+        as SAN. Only rows that are shown get formatted"""
+        return rows.assign(pv=rows["pv"].map(self._variation_san))
+
+    def _variation_san(self, moves):
+        """Same as board.variation_san, but pushes and pops the moves on
+        the board itself instead of working on a copy"""
+        board = self.board
+        parts = []
+        try:
+            for move in moves:
+                san = self.cached_san(board, move)
+                if board.turn == chess.WHITE:
+                    parts.append(f"{board.fullmove_number}. {san}")
+                elif not parts:
+                    parts.append(f"{board.fullmove_number}...{san}")
+                else:
+                    parts.append(san)
+                board.push(move)
+        finally:
+            for _ in parts:
+                board.pop()
+        return " ".join(parts)
+
+    def prefetch_maia(self):
+        """Starts batch inference for the positions most likely to be
+        sampled next, which are the ones with the highest weights. Chunks
+        are queued one at a time so live evaluations never wait long"""
+        likely = self.positions.nlargest(MAIA_PREFETCH_POSITIONS, "time_to_complete")
+        self._prefetch_maia_chunk(list(likely["position"]))
+
+    def _prefetch_maia_chunk(self, fens):
+        if not fens:
+            return
+        future = self._pool.submit(self._prefetch_maia, fens[:MAIA_PREFETCH_CHUNK])
+        future.add_done_callback(
+            partial(self._prefetch_maia_done, fens[MAIA_PREFETCH_CHUNK:])
+        )
 
-    def evaluate_position_with_maia(self):
+    def _prefetch_maia_done(self, rest, future):
+        if future.cancelled():  # By stop_maia
+            return
+        if future.exception() is not None:
+            print(f"Maia prefetch failed: {future.exception()!r}")
+            return
+        with self._maia_lock:
+            if not self._maia_stopped:
+                self._prefetch_maia_chunk(rest)
+
+    def _prefetch_maia(self, candidates):
+        fens = []
+        for fen in candidates:
+            try:
+                board = chess.Board(fen)
+            except ValueError:
+                continue
+            if any(board.legal_moves) and board.fen() not in self._maia_cache:
+                fens.append(board.fen())
+        if not fens:
+            return
+        data = pd.DataFrame(
+            {
+                "board": fens,
+                "move": "",
+                "active_elo": MAIA2_ELO,
+                "opponent_elo": MAIA2_ELO,
+            }
+        )
+        data, _ = inference.inference_batch(
+            data, self.maia2_model, verbose=False, batch_size=len(fens), num_workers=0
+        )
+        self._maia_cache.update(zip(fens, data["move_probs"]))
+
+    def maia_move_probs(self, fen):
+        if fen in self._maia_cache:
+            return self._maia_cache[fen]
         move_probs, win_prob = inference.inference_each(
             self.maia2_model,
             self.maia2_prepared,
-            self.board.fen(),
+            fen,
             MAIA2_ELO,
             MAIA2_ELO,
         )
-        self.eval_data["maia_prob"] = 0.0
+        return move_probs
+
+    def evaluate_position_with_maia(self, move_probs):
+        san_probs = {}
         for uci_str, prob in move_probs.items():
+            prob = round(prob, 2)
             move = chess.Move.from_uci(uci_str)
-            if self.board.is_legal(move):
-                san = self.board.san(move)
-                self.eval_data.loc[self.eval_data["move"] == san, "maia_prob"] = round(
-                    prob, 2
-                )
+            if prob and self.board.is_legal(move):
+                san_probs[self.cached_san(self.board, move)] = prob
+        self._san_probs = san_probs  # For moves added later by evaluate_move
+        self.eval_data["maia_prob"] = (
+            self.eval_data["move"].map(san_probs).fillna(0.0).astype(float)
+        )
+        # Relative to Maia's favourite among all legal moves, not just these
+        max_prob = max(san_probs.values(), default=0.0) or 1.0
         self.eval_data["humanness"] = (
-            (self.eval_data["maia_prob"] / self.eval_data["maia_prob"].max() * 4 + 1)
-            .round()
-            .astype(int)
+            (self.eval_data["maia_prob"] / max_prob * 4 + 1).round().astype(int)
         )
         self.eval_data["humanness"] = self.eval_data["humanness"].map(
             lambda x: self.rating_map.get(x, "")
         )
 
+    def evaluate_move(self, move):
+        """Searches a move outside the top engine lines on its own, the
+        same way as the top lines, and adds its row to eval_data.
+        Returns its SAN"""
+        lines = self.analyse_cached(self.board, 1, root_moves=[move])["lines"]
+        score, pv = lines[0]
+        diff = score - self.eval_data.loc[0, "engine_eval"]
+        san = self.cached_san(self.board, move)
+        maia_prob = self._san_probs.get(san, 0.0)
+        max_prob = max(self._san_probs.values(), default=0.0) or 1.0
+        row = {
+            "engine_rank": "-",  # Searched on its own, so it has no rank
+            "move": san,
+            "engine_eval": score,
+            "diff": diff,
+            "maia_prob": maia_prob,
+            "humanness": self.rating_map.get(round(maia_prob / max_prob * 4 + 1), ""),
+            "class": self.classify_move(self.board.turn, diff),
+            "pv": (pv or [move])[:10],
+        }
+        self.eval_data = pd.concat(
+            [self.eval_data, pd.DataFrame([row])], ignore_index=True
+        )
+        self.move_rows[san] = self.eval_data.index[-1]
+        return san
+
     def classify_all_moves(self):
         for idx, row in self.eval_data.iterrows():
             tag = self.classify_move(self.board.turn, row["diff"])
@@ -171,12 +512,21 @@ class ChessModel:
     def record_result(self, fen: str, correct: bool):
         elapsed = time.time() - self._timer_start
         ttc = elapsed if correct else DEFAULT_TIME_TO_COMPLETE
-        self.positions.loc[
-            self.positions["position"].str.strip() == fen.strip(), "time_to_complete"
-        ] = ttc
-        self.save_positions()
+        self._set_time_to_complete(fen, ttc)
+        # Appending is cheap; the full sort and rewrite happens every
+        # POSITIONS_SAVE_EVERY results and at exit
+        with open(POSITIONS_JOURNAL_FILE, "a", encoding="utf-8", newline="") as f:
+            csv.writer(f, lineterminator="\n").writerow((fen, ttc))
+        self._unsaved_results += 1
+        if self._unsaved_results >= POSITIONS_SAVE_EVERY:
+            self.save_positions()
         return ttc
 
+    def _set_time_to_complete(self, fen, ttc):
+        rows = self._fen_rows.get(fen)
+        if rows:
+            self.positions.loc[rows, "time_to_complete"] = ttc
+
     @staticmethod
     def classify_move(is_white_to_move, diff):
         val = diff if is_white_to_move else -diff
@@ -190,11 +540,28 @@ class ChessModel:
 
 
 class ChessView:
+    # Square shown in each canvas cell, row by row from the top left
+    _SQ_TABLE_NORMAL = [chess.square(c, 7 - r) for r in range(8) for c in range(8)]
+    _SQ_TABLE_FLIPPED = [chess.square(7 - c, r) for r in range(8) for c in range(8)]
+    # (cell index, square, square color parity) per cell, for the draw loop
+    _LAYOUT_NORMAL = [
+        (i, sq, sum(divmod(i, 8)) & 1) for i, sq in enumerate(_SQ_TABLE_NORMAL)
+    ]
+    _LAYOUT_FLIPPED = [
+        (i, sq, sum(divmod(i, 8)) & 1) for i, sq in enumerate(_SQ_TABLE_FLIPPED)
+    ]
+
     def __init__(self, root, model):
         self.root = root
         self.model = model
         self.selected_square = None
-        self.highlight_squares = []
+        self.highlight_squares = set()
+        # Square fill by (square color parity, highlighted)
+        self._color_table = {
+            (parity, highlighted): self._lighten(base, 0.3) if highlighted else base
+            for parity, base in enumerate((DARK_COLOR, LIGHT_COLOR))
+            for highlighted in (False, True)
+        }
 
         self.root.title("no more bad chess moves")
         self.root.geometry("1200x960")
@@ -214,6 +581,20 @@ class ChessView:
         self.board_canvas = tk.Canvas(frame, width=480, height=480)
         self.board_canvas.pack(side="left")
 
+        # Canvas items are created once per cell and updated in place
+        self.square_ids = []
+        self.piece_ids = []
+        # Last fill and piece image given to each cell, so unchanged cells are skipped
+        self._square_colors = [None] * 64
+        self._square_images = [None] * 64
+        for r in range(8):
+            for c in range(8):
+                x0, y0 = c * 60, r * 60
+                self.square_ids.append(
+                    self.board_canvas.create_rectangle(x0, y0, x0 + 60, y0 + 60)
+                )
+                self.piece_ids.append(self.board_canvas.create_image(x0 + 30, y0 + 30))
+
         self.status_label = tk.Label(
             root, text="", font=("Arial", 12), pady=3, anchor="w"
         )
@@ -225,39 +606,47 @@ class ChessView:
         self.log_text.pack(side="left", fill="both", expand=True)
 
     def draw_board(self):
-        self.board_canvas.delete("all")
-        board = self.model.board
-        for r in range(8):
-            for c in range(8):
-                sq = (
-                    chess.square(7 - c, r)
-                    if self.model.flip_board
-                    else chess.square(c, 7 - r)
-                )
-                base = DARK_COLOR if (r + c) % 2 == 0 else LIGHT_COLOR
-                color = base
-                if sq in self.highlight_squares:
-                    color = self._lighten(color, 0.3)
-                x0, y0 = c * 60, r * 60
-                x1, y1 = x0 + 60, y0 + 60
-                self.board_canvas.create_rectangle(
-                    x0, y0, x1, y1, fill=color, outline=color
+        pieces = self.model.board.piece_map()
+        layout = self._LAYOUT_FLIPPED if self.model.flip_board else self._LAYOUT_NORMAL
+        for i, sq, parity in layout:
+            color = self._color_table[parity, sq in self.highlight_squares]
+            if self._square_colors[i] != color:
+                self._square_colors[i] = color
+                self.board_canvas.itemconfig(
+                    self.square_ids[i], fill=color, outline=color
                 )
-                p = board.piece_at(sq)
-                if p:
-                    key = ("w" if p.color else "b") + p.symbol().upper()
-                    img = self.model.piece_images.get(key)
-                    self.board_canvas.create_image(x0 + 30, y0 + 30, image=img)
+            img = ""
+            p = pieces.get(sq)
+            if p:
+                img = self.model.piece_images[(p.piece_type - 1) * 2 + p.color]
+            if self._square_images[i] is not img:
+                self._square_images[i] = img
+                self.board_canvas.itemconfig(self.piece_ids[i], image=img)
+
+    def _square_table(self):
+        if self.model.flip_board:
+            return self._SQ_TABLE_FLIPPED
+        return self._SQ_TABLE_NORMAL
+
+    def square_at(self, x, y):
+        c, r = x // 60, y // 60
+        if not (0 <= c < 8 and 0 <= r < 8):
+            return None
+        return self._square_table()[r * 8 + c]
 
     def log(self, msg):
-        print(msg)
-        self.log_text.insert("end", msg + "\n")
+        self.log_many([msg])
+
+    def log_many(self, msgs):
+        """Logs several lines with a single insert and scroll"""
+        text = "".join(msg + "\n" for msg in msgs)
+        print(text, end="")
+        self.log_text.insert("end", text)
         self.log_text.see("end")
 
     @staticmethod
     def _lighten(hex_color, factor):
-        hex_color = hex_color.lstrip("#")
-        r, g, b = [int(hex_color[i : i + 2], 16) for i in (0, 2, 4)]
+        r, g, b = bytes.fromhex(hex_color.lstrip("#"))
         r = min(int(r + (255 - r) * factor), 255)
         g = min(int(g + (255 - g) * factor), 255)
         b = min(int(b + (255 - b) * factor), 255)
@@ -269,6 +658,11 @@ class ChessController:
         self.model = ChessModel()
         self.view = ChessView(root, self.model)
         self.result_recorded = False
+        self.busy = False
+        # Engine work runs here so it never blocks the Tk main loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetch_cancel = threading.Event()
+        self._maia_prefetched = False
         self._bind_events()
         self._setup()
 
@@ -298,34 +692,73 @@ class ChessController:
         self.view.log_text.delete("1.0", "end")
         self.view.draw_board()
         self.view.log(f"FEN: {fen}")
-        self.model.evaluate_position()
-        self.model.start_timer()
+        self._cancel_prefetch()
         self.result_recorded = False
+        self._run_in_background(self.model.evaluate_position, self._position_ready)
+
+    def _position_ready(self, _):
+        self.model.start_timer()
+        self._start_prefetch()
+        if not self._maia_prefetched:  # Only once the first position is up
+            self._maia_prefetched = True
+            self.model.prefetch_maia()
+
+    def _start_prefetch(self, _=None):
+        """Ponders the likely next positions on the worker thread. It is not
+        awaited: engine work submitted later simply queues behind it"""
+        self._prefetch_cancel = threading.Event()
+        self.executor.submit(
+            self.model.prefetch, self.model.board.copy(), self._prefetch_cancel
+        )
+
+    def _cancel_prefetch(self):
+        self._prefetch_cancel.set()
+
+    def _run_in_background(self, fn, callback=None):
+        """Runs fn on the worker thread, then passes its result to callback
+        on the Tk main loop. Input is disabled in the meantime"""
+        self._set_busy(True)
+        self._await(self.executor.submit(fn), callback)
+
+    def _await(self, future, callback):
+        if not future.done():
+            self.view.root.after(POLL_INTERVAL_MS, self._await, future, callback)
+            return
+        self._set_busy(False)
+        result = future.result()
+        if callback:
+            callback(result)
+
+    def _set_busy(self, busy):
+        self.busy = busy
+        state = "disabled" if busy else "normal"
+        self.view.reload_btn.config(state=state)
+        self.view.next_btn.config(state=state)
 
     def _get_promote_friendly_move(self, from_square, to_square):
         mv = chess.Move(from_square, to_square, promotion=chess.QUEEN)
         return (
             mv
-            if mv in self.model.board.legal_moves
+            if self.model.board.is_legal(mv)
             else chess.Move(from_square, to_square, promotion=None)
         )
 
     def on_click(self, event):
-
-        # TODO: TEST THAT EVALUATION HAS FINISHED!, Otherwise the data isn't ready yet, disallow player input until it's ready
-
-        c, r = event.x // 60, event.y // 60
-        sq = chess.square(7 - c, r) if self.model.flip_board else chess.square(c, 7 - r)
+        if self.busy:
+            return  # Evaluation not ready yet
+        sq = self.view.square_at(event.x, event.y)
+        if sq is None:
+            return
         if self.view.selected_square is None:
             if self.model.board.piece_at(sq):
                 self.view.selected_square = sq
                 self.view.highlight_squares.clear()
-                self.view.highlight_squares.append(sq)
+                self.view.highlight_squares.add(sq)
         else:
             mv = self._get_promote_friendly_move(self.view.selected_square, sq)
             self.view.highlight_squares.clear()
-            self.view.highlight_squares.extend([self.view.selected_square, sq])
-            if mv in self.model.board.legal_moves:
+            self.view.highlight_squares.update((self.view.selected_square, sq))
+            if self.model.board.is_legal(mv):
                 self._process_move(mv)
             else:
                 self.view.log("Illegal move!!! Try again...")
@@ -333,11 +766,19 @@ class ChessController:
         self.view.draw_board()
 
     def _process_move(self, move):
-        san = self.model.board.san(move)
+        self._cancel_prefetch()
+        san = self.model.cached_san(self.model.board, move)
+        if san in self.model.move_rows:
+            self._play_move(move, san)
+        else:
+            self._run_in_background(
+                partial(self.model.evaluate_move, move),
+                partial(self._play_move, move),
+            )
+
+    def _play_move(self, move, san):
         self._log_player_move(san)
-        tag = self.model.eval_data.loc[
-            self.model.eval_data["move"] == san, "class"
-        ].iloc[0]
+        tag = self.model.eval_data.at[self.model.move_rows[san], "class"]
         self._record_time(tag)
         self.model.board.push(move)
         self.view.draw_board()
@@ -346,15 +787,23 @@ class ChessController:
         self._engine_move()
 
     def _log_player_move(self, san_move):
-        current_eval = self.model.eval_data.loc[0, "engine_eval"]
-        self.view.log(f"Evaluation: {current_eval:.2f}")
-        self.view.log("Top engine moves:")
-        self.view.log(self.model.eval_data[:10].to_string())
-        self.view.log("Your move:")
-        move_data = self.model.eval_data.loc[
-            self.model.eval_data["move"] == san_move
-        ].to_string()
-        self.view.log(move_data)
+        eval_data = self.model.eval_data
+        current_eval = eval_data.loc[0, "engine_eval"]
+        # Rows evaluate_move adds for off-list moves come after the engine's
+        top_lines = self.model.with_pv_san(eval_data[:MAX_MOVES_TO_EVALUATE])
+        top_lines = top_lines.to_string()
+        move_data = self.model.with_pv_san(
+            eval_data.loc[[self.model.move_rows[san_move]]]
+        ).to_string()
+        self.view.log_many(
+            [
+                f"Evaluation: {current_eval:.2f}",
+                "Top engine moves:",
+                top_lines,
+                "Your move:",
+                move_data,
+            ]
+        )
 
     def _record_time(self, tag):
         if not self.result_recorded:
@@ -367,20 +816,23 @@ class ChessController:
     def _engine_move(self):
         if self.model.board.is_game_over():
             return
-        res = self.model.engine.play(
-            self.model.board, chess.engine.Limit(time=ENGINE_TIME_LIMIT)
-        )
-        mv = res.move
-        san = self.model.board.san(mv)
+        self._run_in_background(self._engine_reply, self._show_engine_move)
+
+    def _engine_reply(self):
+        res = self.model.engine.play(self.model.board, ENGINE_LIMIT)
+        return res.move
+
+    def _show_engine_move(self, mv):
+        san = self.model.cached_san(self.model.board, mv)
         self.model.board.push(mv)
         self.view.highlight_squares.clear()
-        self.view.highlight_squares.extend([mv.from_square, mv.to_square])
+        self.view.highlight_squares.update((mv.from_square, mv.to_square))
         self.view.draw_board()
         self.view.log(f"Engine plays: {san}")
         self._announce_state()
         if self.model.board.is_game_over():
             return
-        self.model.evaluate_position()
+        self._run_in_background(self.model.evaluate_position, self._start_prefetch)
 
     def _announce_state(self):
         b = self.model.board
@@ -394,8 +846,15 @@ class ChessController:
             self.view.log("Check!")
 
 
-if __name__ == "__main__":
+def main():
     root = tk.Tk()
     app = ChessController(root)
     root.mainloop()
+    app._cancel_prefetch()
+    app.executor.shutdown(cancel_futures=True)
     app.model.stop_engine()
+    app.model.stop_maia()
+
+
+if __name__ == "__main__":
+    main()